@@ -17,6 +17,8 @@
 
 import json
 import re
+import hmac
+import hashlib
 import ipaddress
 import os
 import time
@@ -24,6 +26,8 @@ import threading
 import random
 import sys
 import socket
+import http.client
+from collections import deque
 from socketserver import ThreadingMixIn
 from http.server import HTTPServer, BaseHTTPRequestHandler
 
@@ -35,7 +39,8 @@ from http.server import HTTPServer, BaseHTTPRequestHandler
 # Server version
 SOFTWARE_VERSION = (1, 0, 0)
 LOG_LEVEL_NAMES = ["DBUG", "INFO", "WARN", "ERRO"]
-# Name of the config file and location (same dir as script)
+# Name of the config file and location (same dir as script). Can be
+# overridden by passing a path as the first command line argument
 CONF_LOCATION = os.path.join(os.path.dirname(os.path.realpath(__file__)),
                              "lanTalkSrv.conf")
 # Length of the suffix (numbers after the dot)
@@ -43,6 +48,51 @@ ID_SUFFIX_LENGTH = 10
 # How many seconds to wait until marking a user offline
 # (by default, client sends heartbeats every 2 seconds)
 MARK_AS_OFFLINE_DELAY = 5
+# How often (seconds) each federated server announces that it's alive
+# and how often links send something to keep the connection open
+FEDERATION_HEARTBEAT_INTERVAL = 5
+# How many seconds without hearing from a federated server until its
+# users are forgotten (and discovered links to it are dropped)
+FEDERATION_NODE_TIMEOUT = 15
+# How often (seconds) to look for other servers on the LAN
+FEDERATION_DISCOVERY_INTERVAL = 5
+# Socket timeout (seconds) for requests sent to federated servers
+FEDERATION_LINK_TIMEOUT = 5
+# Maximum number of events sent to a peer in one request
+FEDERATION_BATCH_SIZE = 100
+# Maximum number of events waiting to be sent to a single peer (the
+# oldest ones are dropped when a peer is unreachable for too long)
+FEDERATION_QUEUE_LIMIT = 10000
+# How many seconds an event may spend queued (over all servers it passed
+# through) before it's dropped. Servers forget the sequence numbers of
+# origins they haven't heard from for FEDERATION_NODE_TIMEOUT, so events
+# must arrive before then (leaving time for the last request)
+FEDERATION_EVENT_MAX_AGE = FEDERATION_NODE_TIMEOUT - FEDERATION_LINK_TIMEOUT
+# How many out-of-order sequence numbers to remember per origin server
+FEDERATION_DEDUP_WINDOW = 1024
+# URL path used by servers to talk to each other
+FEDERATION_PATH = "/federation"
+# URL path for relaying messages and presence changes by hand (until
+# the client messaging protocol exists). Only with FederationDebug
+FEDERATION_RELAY_PATH = "/federation/relay"
+# How many of the latest channel messages to remember
+FEDERATION_MESSAGE_HISTORY = 100
+# Headers of signed federation requests. The signature is a hex
+# HMAC-SHA256 (keyed with the FederationSecret) of the method, path,
+# time, nonce and body, and replies are signed the same way over the
+# request's nonce and the reply body, so the secret itself is never sent
+FEDERATION_TIME_HEADER = "X-LanTalk-Federation-Time"
+FEDERATION_NONCE_HEADER = "X-LanTalk-Federation-Nonce"
+FEDERATION_SIGNATURE_HEADER = "X-LanTalk-Federation-Signature"
+# How many seconds a signed request stays valid (clocks of federated
+# servers must be within this of each other)
+FEDERATION_SIGNATURE_MAX_AGE = 60
+# Dict of federation event types and the fields their data must contain
+FEDERATION_EVENT_FIELDS = {
+    "heartbeat": ["users"],
+    "message": ["channel", "username", "text"],
+    "presence": ["username", "status"],
+}
 
 # Dict of config options and functions to validate them.
 # Each function takes one argument, the value.
@@ -60,6 +110,12 @@ VALID_CONF_OPTIONS = {
     "RequireAuth": lambda val: True if val.lower() in ["yes", "no"] else False, # Check if is "yes" or "no" and ignore caps
     "AuthFile": lambda val: True if os.path.isfile(val) else False, # If the file exists
     "SslCertFile": lambda val: True if os.path.isfile(val) else False, # If the file exists
+    "Federation": lambda val: True if val.lower() in ["yes", "no"] else False, # Check if is "yes" or "no" and ignore caps
+    "FederationPeers": lambda val: True if val == "" or all(re.search(r"^[^\s:]+:\d{1,5}$", peer.strip()) and 1 <= int(peer.rsplit(":", 1)[1]) <= 65535 for peer in val.split(",")) else False, # Comma-separated list of host:port
+    "FederationDiscovery": lambda val: True if val.lower() in ["yes", "no"] else False, # Check if is "yes" or "no" and ignore caps
+    "FederationDiscoveryPort": lambda val: True if val.isnumeric() and int(val) >= 1 and int(val) <= 65535 else False, # Check if valid port
+    "FederationSecret": lambda val: True if val != "" else False, # Any non-empty string
+    "FederationDebug": lambda val: True if val.lower() in ["yes", "no"] else False, # Check if is "yes" or "no" and ignore caps
 }
 
 DEFAULT_CONF_OPTIONS = {
@@ -76,6 +132,12 @@ DEFAULT_CONF_OPTIONS = {
     "RequireAuth": "yes",
     "AuthFile": "lanTalkSrv-auth.dat",
     "SslCertFile": "",
+    "Federation": "no",
+    "FederationPeers": "",
+    "FederationDiscovery": "yes",
+    "FederationDiscoveryPort": "8867",
+    "FederationSecret": "",
+    "FederationDebug": "no",
 }
 
 #
@@ -200,6 +262,18 @@ def get_file_contents(file_name, parent_dir=None):
     with open(file_path, "rb") as file:
         return file.read()
 
+
+# Federation functions
+def federation_sign(*parts):
+    """
+    Sign the parts of a federation request or reply.
+
+    Returns a hex HMAC-SHA256 of the parts (joined by newlines) keyed
+    with the FederationSecret.
+    """
+    message = b"\n".join([part if type(part) == bytes else str(part).encode("utf-8") for part in parts])
+    return hmac.new(CONF["FederationSecret"].encode("utf-8"), message, hashlib.sha256).hexdigest()
+
 #
 # Server classes
 #
@@ -213,6 +287,9 @@ class LanTalkServer(ThreadingMixIn, HTTPServer):
     messages_to_send = []  # List of messages that are yet to be sent
     threads = []  # A list of threads created by the server
     run_threads = True  # Variable to control whether threads should be running
+    # Don't let open connections (for example, persistent links from
+    # federated servers) keep the process alive after the server stops
+    daemon_threads = True
 
     # On object creation
     def __init__(self, bind_addr, request_handler):
@@ -224,6 +301,25 @@ class LanTalkServer(ThreadingMixIn, HTTPServer):
         # Save the request handler as a property (to allow exchanging data)
         self.request_handler = request_handler
 
+        # Federation state (per instance, as it's modified by many threads)
+        self.federation_enabled = CONF["Federation"].lower() == "yes" and self.federation_conf_valid()
+        # Whether the status and relay endpoints are enabled
+        self.federation_debug = self.federation_enabled and CONF["FederationDebug"].lower() == "yes"
+        # Random ID identifying this run of the server to other servers.
+        # A restarted server gets a new ID so its sequence numbers can
+        # safely start from zero again
+        self.federation_node_id = "{}.{}".format(self.server_address[1], "".join([str(random.randint(1,9)) for x in range(ID_SUFFIX_LENGTH)]))
+        self.federation_sequence = 0  # Sequence number of the last event created here
+        self.federation_links = {}  # Dict of FederationLinks with "host:port" as keys
+        self.federation_seen = {}  # Dict of origin IDs and [lowest seq, set of newer seqs] seen
+        self.federation_nodes = {}  # Dict of origin IDs and when they were last heard from
+        self.remote_clients = {}  # Dict of users on other servers and their origin IDs
+        self.federation_presence_seq = {}  # Dict of origin IDs and the seq of their last applied presence
+        self.local_users = set()  # Users online on this server (sent with every heartbeat)
+        self.recent_messages = deque(maxlen=FEDERATION_MESSAGE_HISTORY)  # Latest channel messages (local and federated)
+        self.federation_nonces = {}  # Dict of nonces of accepted requests and when they arrived
+        self.federation_lock = threading.RLock()  # Guards all of the above
+
         # Log that threads are being started
         log(0, "Starting threads")
         # Start the threads (get all methods of the object and if their
@@ -235,6 +331,14 @@ class LanTalkServer(ThreadingMixIn, HTTPServer):
             self.threads[-1].start()
         log(0, "All threads started")
 
+        # Connect to the federated servers listed in the config
+        if self.federation_enabled:
+            log(1, "Federation enabled (node ID: {})".format(self.federation_node_id))
+            for peer in CONF["FederationPeers"].split(","):
+                if peer.strip() != "":
+                    host, port = peer.strip().rsplit(":", 1)
+                    self.federation_add_peer(host, int(port), static=True)
+
     # Client management methods
     def generate_session_id(self, username):
         """
@@ -245,6 +349,237 @@ class LanTalkServer(ThreadingMixIn, HTTPServer):
         # Session IDs will consist of the username and a random ID
         return "{}.{}".format(username, "".join([str(random.randint(1,9)) for x in range(ID_SUFFIX_LENGTH)]))
 
+    # Federation methods
+    def federation_conf_valid(self):
+        """
+        Check the federation settings, logging any invalid ones.
+
+        Done here since conf_validate doesn't check every setting yet.
+        """
+        valid = True
+        for setting in [setting for setting in VALID_CONF_OPTIONS.keys() if setting.startswith("Federation")]:
+            if setting == "FederationSecret" and CONF[setting] == "":
+                log(3, "Setting `FederationSecret` in config file `{}` must be set to use federation! Federation disabled.".format(CONF_LOCATION))
+                valid = False
+            elif not VALID_CONF_OPTIONS[setting](CONF[setting]):
+                log(3, "Invalid value `{}` for setting `{}` in config file `{}`! Federation disabled.".format(CONF[setting], setting, CONF_LOCATION))
+                valid = False
+        return valid
+
+    def federation_add_peer(self, host, port, static=False, node_id=None):
+        """
+        Start a persistent link to another server unless one exists.
+
+        Static peers (from the config) are retried forever while
+        discovered ones are dropped once they stop responding.
+        """
+        # Ports come from other servers so check them (JSON can hold floats
+        # such as 1e999 which int() can't convert)
+        if type(port) != int or port < 1 or port > 65535:
+            raise ValueError("invalid port `{}`".format(port))
+        key = "{}:{}".format(host, port)
+        with self.federation_lock:
+            # Don't link to ourselves or to servers which are linked already
+            if node_id == self.federation_node_id or key in self.federation_links:
+                return
+            if node_id is not None and any(link.node_id == node_id for link in self.federation_links.values()):
+                return
+            link = FederationLink(self, host, port, static)
+            self.federation_links[key] = link
+            link.thread = threading.Thread(target=link.run)
+            self.threads.append(link.thread)
+            link.thread.start()
+        log(1, "Linking with federated server [{}]".format(key))
+
+    def federation_nonce_fresh(self, nonce, timestamp):
+        """
+        Check that a signed request is recent and wasn't received before.
+
+        Remembers the nonce so the request can't be replayed.
+        """
+        try:
+            if not abs(time.time() - float(timestamp)) <= FEDERATION_SIGNATURE_MAX_AGE:
+                return False
+        except ValueError:
+            return False
+        with self.federation_lock:
+            if nonce == "" or nonce in self.federation_nonces:
+                return False
+            self.federation_nonces[nonce] = time.time()
+            return True
+
+    def federation_link_identified(self, link, node_id):
+        """
+        Record which server a link leads to once it replied.
+
+        Only one link per server is kept, preferring static ones. Returns
+        False if the link is a duplicate which should be dropped.
+        """
+        with self.federation_lock:
+            for other in self.federation_links.values():
+                if other is link or other.node_id != node_id:
+                    continue
+                if not link.static:
+                    return False
+                if not other.static:
+                    other.closed = True
+            link.node_id = node_id
+            return True
+
+    def federation_remove_link(self, link):
+        """Forget a link to a federated server once its thread is exiting."""
+        with self.federation_lock:
+            if self.federation_links.get(link.key) is link:
+                del self.federation_links[link.key]
+            if link.thread in self.threads:
+                self.threads.remove(link.thread)
+
+    def federation_publish(self, event_type, data):
+        """Create an event originating from this server and send it to all peers."""
+        with self.federation_lock:
+            self.federation_sequence += 1
+            event = {
+                "origin": self.federation_node_id,
+                "seq": self.federation_sequence,
+                "type": event_type,
+                "data": data,
+            }
+            self.federation_mark_seen(event["origin"], event["seq"])
+            links = list(self.federation_links.values())
+        for link in links:
+            link.queue([event])
+
+    def federation_mark_seen(self, origin, seq):
+        """
+        Record an event as seen. Returns False if it was seen before.
+
+        Only sequence numbers above the lowest unbroken one are kept so
+        events relayed out of order (through different peers) still pass.
+        Must be called with the federation lock held.
+        """
+        lowest, newer = self.federation_seen.setdefault(origin, [0, set()])
+        if seq <= lowest or seq in newer:
+            return False
+        newer.add(seq)
+        # Move the lowest unbroken sequence number forward
+        while lowest + 1 in newer:
+            lowest += 1
+            newer.remove(lowest)
+        # If events went missing for good, don't keep waiting for them
+        while len(newer) > FEDERATION_DEDUP_WINDOW:
+            lowest = min(newer)
+            newer.remove(lowest)
+        self.federation_seen[origin][0] = lowest
+        return True
+
+    def federation_event_valid(self, event):
+        """Check that an event from another server has all required fields."""
+        return (type(event) == dict
+                and type(event.get("origin")) == str
+                and type(event.get("seq")) == int
+                and event.get("type") in FEDERATION_EVENT_FIELDS
+                and type(event.get("data")) == dict
+                and type(event.get("age", 0)) in [int, float]
+                and 0 <= event.get("age", 0) <= FEDERATION_EVENT_MAX_AGE
+                and all(field in event["data"] for field in FEDERATION_EVENT_FIELDS[event["type"]]))
+
+    def federation_receive(self, payload, sender_host):
+        """
+        Handle events sent by another server.
+
+        New events are applied locally and passed on to every other peer,
+        so servers which aren't linked directly still receive them.
+        Invalid events are logged and skipped so they can't stop the rest
+        of the batch. Returns the ID of this server (so the sender can
+        spot self-links).
+        """
+        sender_id = str(payload["node"])
+        # Link back to the sender so that our events reach it too
+        self.federation_add_peer(sender_host, payload["port"], node_id=sender_id)
+        new_events = []
+        for event in payload.get("events", []):
+            if not self.federation_event_valid(event):
+                log(2, "Ignored invalid federation event from `{}`: {}".format(sender_id, event))
+                continue
+            with self.federation_lock:
+                if not self.federation_mark_seen(event["origin"], event["seq"]):
+                    continue
+                self.federation_nodes[event["origin"]] = time.time()
+            try:
+                self.federation_apply(event)
+            except (ValueError, KeyError, TypeError, AttributeError) as err:
+                log(2, "Could not apply federation event from `{}`: {}".format(event["origin"], err))
+                continue
+            new_events.append(event)
+        with self.federation_lock:
+            self.federation_nodes[sender_id] = time.time()
+            links = [link for link in self.federation_links.values() if link.node_id != sender_id]
+        if new_events:
+            for link in links:
+                link.queue([event for event in new_events if event["origin"] != link.node_id])
+        return self.federation_node_id
+
+    def federation_apply(self, event):
+        """Apply an event from another server to this server."""
+        if event["type"] == "message":
+            # Remember the message (delivering it to local users is up to
+            # the messaging protocol)
+            self.recent_messages.append(dict(event["data"], origin=event["origin"]))
+        elif event["type"] in ["presence", "heartbeat"]:
+            with self.federation_lock:
+                # Ignore presence older than what was applied already
+                # (events can arrive out of order through different peers)
+                if event["seq"] < self.federation_presence_seq.get(event["origin"], 0):
+                    return
+                self.federation_presence_seq[event["origin"]] = event["seq"]
+                if event["type"] == "heartbeat":
+                    # Heartbeats carry every online user of their server so
+                    # servers which joined late (or lost contact) catch up
+                    if type(event["data"]["users"]) != list:
+                        raise TypeError("heartbeat users must be a list")
+                    for username in [user for user, origin in self.remote_clients.items() if origin == event["origin"]]:
+                        del self.remote_clients[username]
+                    for username in event["data"]["users"]:
+                        self.remote_clients[str(username)] = event["origin"]
+                elif event["data"]["status"] == "online":
+                    self.remote_clients[event["data"]["username"]] = event["origin"]
+                elif self.remote_clients.get(event["data"]["username"]) == event["origin"]:
+                    del self.remote_clients[event["data"]["username"]]
+            if event["type"] == "presence":
+                log(0, "Federated user `{}` is now {}".format(event["data"]["username"], event["data"]["status"]))
+
+    def federation_status(self):
+        """Return a summary of the federation state as a dict."""
+        with self.federation_lock:
+            return {
+                "node": self.federation_node_id,
+                "links": {key: link.node_id for key, link in self.federation_links.items()},
+                "nodes": sorted(self.federation_nodes.keys()),
+                "local_users": sorted(self.local_users),
+                "remote_clients": dict(self.remote_clients),
+                "messages": list(self.recent_messages),
+            }
+
+    # Messaging methods
+    def relay_channel_message(self, channel, username, text):
+        """Record a channel message and send it to federated servers."""
+        message = {"channel": channel, "username": username, "text": text, "time": time.time()}
+        self.recent_messages.append(dict(message, origin=self.federation_node_id))
+        if self.federation_enabled:
+            self.federation_publish("message", message)
+
+    def relay_presence(self, username, status):
+        """Tell federated servers that a local user went "online" or "offline"."""
+        # Publish while holding the lock so no heartbeat with an older
+        # list of users gets a newer sequence number than this change
+        with self.federation_lock:
+            if status == "online":
+                self.local_users.add(username)
+            else:
+                self.local_users.discard(username)
+            if self.federation_enabled:
+                self.federation_publish("presence", {"username": username, "status": status})
+
     # Thread methods
     def thread_login_manager(self):
         """Manage user logins thread."""
@@ -261,7 +596,87 @@ class LanTalkServer(ThreadingMixIn, HTTPServer):
             for client in self.signed_in_clients:
                 pass  # TODO: Create the thread
 
+    def thread_federation_heartbeat(self):
+        """
+        Announce that this server is alive and forget silent servers.
+
+        Every heartbeat lists the users online here. Users of servers
+        which weren't heard from recently are removed.
+        """
+        if not self.federation_enabled:
+            return
+        while self.run_threads:
+            with self.federation_lock:
+                self.federation_publish("heartbeat", {"users": sorted(self.local_users)})
+            with self.federation_lock:
+                for node_id, last_seen in list(self.federation_nodes.items()):
+                    if time.time() - last_seen > FEDERATION_NODE_TIMEOUT:
+                        # Its events can't come back later as links drop
+                        # events older than FEDERATION_EVENT_MAX_AGE
+                        del self.federation_nodes[node_id]
+                        self.federation_seen.pop(node_id, None)
+                        self.federation_presence_seq.pop(node_id, None)
+                        for username in [user for user, origin in self.remote_clients.items() if origin == node_id]:
+                            del self.remote_clients[username]
+                        log(1, "Lost contact with federated server `{}`".format(node_id))
+                # Requests signed this long ago are rejected by their time
+                # (which may be up to FEDERATION_SIGNATURE_MAX_AGE ahead)
+                for nonce, received in list(self.federation_nonces.items()):
+                    if time.time() - received > 2 * FEDERATION_SIGNATURE_MAX_AGE:
+                        del self.federation_nonces[nonce]
+            self.wait(FEDERATION_HEARTBEAT_INTERVAL)
+
+    def thread_federation_discovery_broadcaster(self):
+        """Periodically broadcast this server's presence to other servers."""
+        if not self.federation_enabled or CONF["FederationDiscovery"].lower() != "yes":
+            return
+        announcement = json.dumps({"lantalk_federation": self.federation_node_id, "port": self.server_address[1]}).encode("utf-8")
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        except OSError as err:
+            log(3, "Could not create federation broadcast socket, discovery disabled: {}".format(err))
+            return
+        with sock:
+            while self.run_threads:
+                try:
+                    sock.sendto(announcement, ("<broadcast>", int(CONF["FederationDiscoveryPort"])))
+                except OSError as err:
+                    log(0, "Could not send federation broadcast: {}".format(err))
+                self.wait(FEDERATION_DISCOVERY_INTERVAL)
+
+    def thread_federation_discovery_listener(self):
+        """Listen for broadcasts from other servers and link with them."""
+        if not self.federation_enabled or CONF["FederationDiscovery"].lower() != "yes":
+            return
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            try:
+                # Allow several servers on one machine to share the port
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if hasattr(socket, "SO_REUSEPORT"):
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                sock.bind(("", int(CONF["FederationDiscoveryPort"])))
+            except OSError as err:
+                log(3, "Could not listen for federation broadcasts on port {}, discovery disabled: {}".format(CONF["FederationDiscoveryPort"], err))
+                return
+            sock.settimeout(1)
+            while self.run_threads:
+                try:
+                    data, address = sock.recvfrom(1024)
+                    announcement = json.loads(data.decode("utf-8"))
+                    self.federation_add_peer(address[0], announcement["port"], node_id=announcement["lantalk_federation"])
+                except socket.timeout:
+                    pass
+                except (ValueError, KeyError, TypeError):
+                    log(0, "Ignored invalid federation broadcast")
+
     # Misc. methods
+    def wait(self, seconds):
+        """Sleep for the given time, returning early if threads are stopped."""
+        end = time.time() + seconds
+        while self.run_threads and time.time() < end:
+            time.sleep(min(0.5, end - time.time()))
+
     def stop_threads(self, wait_for_threads=True):
         """
         Stop threads started by this class. Optionally wait for their exit.
@@ -274,10 +689,139 @@ class LanTalkServer(ThreadingMixIn, HTTPServer):
         self.run_threads = False
         # Wait for the threads to exit if told to
         if wait_for_threads:
-            for thread in self.threads:
+            # Copy as link threads remove themselves from the list
+            for thread in list(self.threads):
                 thread.join()
 
 
+class FederationLink():
+    """
+    A persistent connection to another (federated) LanTalk server.
+
+    Events are queued and sent in batches over a single keep-alive
+    HTTP connection by the link's own thread.
+    """
+
+    def __init__(self, server, host, port, static=False):
+        """Initialise link properties. The connection is made by `run`."""
+        self.server = server  # The local LanTalkServer
+        self.host = host
+        self.port = port
+        self.key = "{}:{}".format(host, port)
+        self.static = static  # Whether the peer is from the config
+        self.node_id = None  # ID of the remote server once it replied (with a valid signature)
+        self.events = deque(maxlen=FEDERATION_QUEUE_LIMIT)  # [time queued, age then, event] yet to be sent
+        self.events_available = threading.Event()  # Set when events are queued
+        self.connection = None
+        self.thread = None  # The thread running `run`
+        self.closed = False  # Set to make `run` exit (eg. duplicate link)
+        self.last_sent = 0  # Time of the last successful request
+        self.last_success = time.time()  # Time the link last worked (or was made)
+
+    def queue(self, events):
+        """
+        Queue events to be sent to the remote server.
+
+        Events relayed from other servers keep the age they arrived with.
+        """
+        if events:
+            self.events.extend([[time.time(), event.get("age", 0), event] for event in events])
+            self.events_available.set()
+
+    def age(self, entry):
+        """Return how long (seconds) a queued event has been queued in total."""
+        return entry[1] + time.time() - entry[0]
+
+    def send(self, events):
+        """
+        Send events (possibly none, as a heartbeat) and return the reply.
+
+        Raises ConnectionError if the reply isn't signed with the secret.
+        """
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.host, self.port, timeout=FEDERATION_LINK_TIMEOUT)
+        body = json.dumps({
+            "node": self.server.federation_node_id,
+            "port": self.server.server_address[1],
+            "events": events,
+        }).encode("utf-8")
+        timestamp = str(time.time())
+        nonce = os.urandom(16).hex()
+        headers = {
+            "Content-Type": "application/json",
+            FEDERATION_TIME_HEADER: timestamp,
+            FEDERATION_NONCE_HEADER: nonce,
+            FEDERATION_SIGNATURE_HEADER: federation_sign("POST", FEDERATION_PATH, timestamp, nonce, body),
+        }
+        self.connection.request("POST", FEDERATION_PATH, body, headers)
+        response = self.connection.getresponse()
+        reply = response.read()
+        if response.status != 200:
+            raise ConnectionError("HTTP {} {}".format(response.status, response.reason))
+        if not hmac.compare_digest(response.getheader(FEDERATION_SIGNATURE_HEADER, "").encode("latin-1", "replace"), federation_sign(nonce, reply).encode("utf-8")):
+            raise ConnectionError("reply not signed with the FederationSecret")
+        return json.loads(reply.decode("utf-8"))
+
+    def run(self):
+        """Send queued events until the server stops or the link is dropped."""
+        failing = False
+        batch = []  # Events which couldn't be sent yet (retried first)
+        while self.server.run_threads and not self.closed:
+            self.events_available.wait(1)
+            self.events_available.clear()
+            # Only send events once the server proved it knows the secret
+            # (anyone on the LAN can pretend to be a server)
+            if not batch and self.node_id is not None:
+                batch = [self.events.popleft() for x in range(min(FEDERATION_BATCH_SIZE, len(self.events)))]
+            # Drop events the other servers may have forgotten the origin of
+            # (they could be applied twice)
+            fresh = [entry for entry in batch if self.age(entry) <= FEDERATION_EVENT_MAX_AGE]
+            if len(fresh) != len(batch):
+                log(0, "Dropped {} old events for federated server [{}]".format(len(batch) - len(fresh), self.key))
+                batch = fresh
+                if not batch and self.events:
+                    self.events_available.set()
+                    continue
+            # Send even if there's nothing queued once in a while to keep
+            # the connection alive (and to introduce ourselves at first)
+            if not batch and time.time() - self.last_sent < FEDERATION_HEARTBEAT_INTERVAL:
+                continue
+            try:
+                reply = self.send([dict(entry[2], age=self.age(entry)) for entry in batch])
+            except (OSError, http.client.HTTPException, ValueError) as err:
+                # The batch is kept aside for when the server comes back
+                # (rather than re-queued, which would push out the newest
+                # events once the queue is full)
+                if self.connection is not None:
+                    self.connection.close()
+                    self.connection = None
+                if not failing:
+                    log(2, "Federated server [{}] unreachable: {}".format(self.key, err))
+                    failing = True
+                if not self.static and time.time() - self.last_success > FEDERATION_NODE_TIMEOUT:
+                    log(1, "Dropping link to federated server [{}]".format(self.key))
+                    break
+                self.server.wait(FEDERATION_HEARTBEAT_INTERVAL)
+                continue
+            batch = []
+            self.last_sent = self.last_success = time.time()
+            if failing:
+                log(1, "Federated server [{}] reachable again".format(self.key))
+                failing = False
+            if reply.get("node") == self.server.federation_node_id:
+                log(0, "Federated server [{}] is this server, dropping link".format(self.key))
+                break
+            if not self.server.federation_link_identified(self, reply.get("node")):
+                log(0, "Already linked with federated server [{}], dropping duplicate link".format(self.key))
+                break
+            # Continue straight away if there's more to send
+            if self.events:
+                self.events_available.set()
+        if self.connection is not None:
+            self.connection.close()
+        self.server.federation_remove_link(self)
+
+
 class LanTalkServerRequestHandler(BaseHTTPRequestHandler):
     """Handle and processes requests made to the server."""
 
@@ -294,24 +838,102 @@ class LanTalkServerRequestHandler(BaseHTTPRequestHandler):
 
     def do_GET(self):
         """Run when a GET request is received."""
+        # Federation status (for debugging)
+        if self.path == FEDERATION_PATH and self.server.federation_debug:
+            if self.federation_authorised():
+                self.federation_respond(json.dumps(self.server.federation_status()))
+            return
         # Temporary. GET requests will serve the panel at some
         # point in the future (TODO)
         self.respond("Nothing here yet!")
 
     def do_POST(self):  # The chat protocol will use POST requests
         """Run when a POST requets is received."""
+        # Requests from federated servers
+        if self.path == FEDERATION_PATH and self.server.federation_enabled:
+            # Always read the body so it isn't mistaken for the next
+            # request on a persistent connection
+            body = self.read_body()
+            if self.federation_authorised(body):
+                try:
+                    payload = json.loads(body.decode("utf-8"))
+                    node_id = self.server.federation_receive(payload, self.client_address[0])
+                except (ValueError, KeyError, TypeError) as err:
+                    log(2, "Invalid federation request from {}: {}".format(self.client_address[0], err))
+                    self.respond("Invalid federation request", 400, "Bad Request")
+                    return
+                self.federation_respond(json.dumps({"node": node_id}))
+            return
+        # Messages and presence changes relayed by hand (for debugging)
+        if self.path == FEDERATION_RELAY_PATH and self.server.federation_debug:
+            body = self.read_body()
+            if self.federation_authorised(body):
+                try:
+                    relay = json.loads(body.decode("utf-8"))
+                    if relay["type"] == "message":
+                        self.server.relay_channel_message(str(relay["channel"]), str(relay["username"]), str(relay["text"]))
+                    elif relay["type"] == "presence" and relay["status"] in ["online", "offline"]:
+                        self.server.relay_presence(str(relay["username"]), relay["status"])
+                    else:
+                        raise ValueError("unknown relay `{}`".format(relay))
+                except (ValueError, KeyError, TypeError) as err:
+                    log(2, "Invalid relay request from {}: {}".format(self.client_address[0], err))
+                    self.respond("Invalid relay request", 400, "Bad Request")
+                    return
+                self.federation_respond("Relayed")
+            return
         pass  # TODO: Implement messaging protocol
 
     # Misc. methods
-    def respond(self, message):
+    def read_body(self):
+        """
+        Read the request body as bytes.
+
+        If its length is unknown, the connection is closed after responding.
+        """
+        try:
+            return self.rfile.read(int(self.headers["Content-Length"]))
+        except (ValueError, TypeError):
+            self.close_connection = True
+            return b""
+
+    def federation_authorised(self, body=b""):
+        """
+        Check that the request was signed with the FederationSecret.
+
+        Responds with an error and returns False if it wasn't. The nonce
+        is kept for signing the reply.
+        """
+        timestamp = self.headers.get(FEDERATION_TIME_HEADER, "")
+        nonce = self.headers.get(FEDERATION_NONCE_HEADER, "")
+        # Compare bytes as compare_digest only accepts ASCII strings. Header
+        # values are decoded as latin-1 so this gives back the bytes sent
+        signature = self.headers.get(FEDERATION_SIGNATURE_HEADER, "").encode("latin-1", "replace")
+        if (hmac.compare_digest(signature, federation_sign(self.command, self.path, timestamp, nonce, body).encode("utf-8"))
+                and self.server.federation_nonce_fresh(nonce, timestamp)):
+            self.federation_nonce = nonce
+            return True
+        log(2, "Rejected federation request from {} (bad signature)".format(self.client_address[0]))
+        self.respond("Bad federation signature", 403, "Forbidden")
+        return False
+
+    def federation_respond(self, message):
+        """Send a reply to an authorised federation request, signed."""
+        self.respond(message, headers={FEDERATION_SIGNATURE_HEADER: federation_sign(self.federation_nonce, message)})
+
+    def respond(self, message, code=200, reason="LanTalk Accepted Request", headers=None):
         """Send a response to the client with the message."""
+        # Encode first so the length is in bytes, not characters
+        message = message.encode("utf-8")
+
         # Add headers
-        self.send_response(200, "LanTalk Accepted Request")
+        self.send_response(code, reason)
         self.send_header("Content-Length", len(message))  # For persistent conn
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
         self.end_headers()
 
         # Send the message
-        message = message.encode("utf-8")
         self.wfile.write(message)
 
 #
@@ -324,6 +946,12 @@ def main():
     # Define CONF as global as all parts of the script use it
     global CONF
 
+    # Allow using another config (for example, to run several
+    # federated servers on one machine)
+    global CONF_LOCATION
+    if len(sys.argv) > 1:
+        CONF_LOCATION = os.path.realpath(sys.argv[1])
+
     # Define server as a global so that the request handler
     # can access it's properties when requests are made
     global server